@@ -1,5 +1,6 @@
 import sys
 import random
+from collections import defaultdict, deque
 from crossword import *
 
 class CrosswordCreator():
@@ -9,10 +10,35 @@ class CrosswordCreator():
         Create new CSP crossword generate.
         """
         self.crossword = crossword
+        # Group the words by length, each variable only starts with the words of its length
+        words_by_length = defaultdict(set)
+        for word in self.crossword.words:
+            words_by_length[len(word)].add(word)
         self.domains = {
-            var: self.crossword.words.copy()
+            var: set(words_by_length[var.length])
             for var in self.crossword.variables
         }
+        # Letter index of each domain, built lazily by `support`
+        self._support_index = {}
+        # Cache the structure of the crossword, it doesn't change while solving
+        self._var_list = tuple(self.crossword.variables)
+        self._n_vars = len(self._var_list)
+        self._neighbors = {
+            var: frozenset(self.crossword.neighbors(var))
+            for var in self._var_list
+        }
+        self._overlap = dict(self.crossword.overlaps)
+        # Consistency checker of each variable, see `compile_check`
+        self._checks = {var: self.compile_check(var) for var in self._var_list}
+        # Cells of the grid that are part of the crossword
+        self._cells = [
+            (i, j)
+            for i in range(self.crossword.height)
+            for j in range(self.crossword.width)
+            if self.crossword.structure[i][j]
+        ]
+        # Values removed from the domains, in order, so they can be restored when backtracking
+        self._trail = []
 
     def letter_grid(self, assignment):
         """
@@ -23,11 +49,14 @@ class CrosswordCreator():
             for _ in range(self.crossword.height)
         ]
         for variable, word in assignment.items():
-            direction = variable.direction
-            for k in range(len(word)):
-                i = variable.i + (k if direction == Variable.DOWN else 0)
-                j = variable.j + (k if direction == Variable.ACROSS else 0)
-                letters[i][j] = word[k]
+            i, j = variable.i, variable.j
+            # Across words fill a slice of one row
+            if variable.direction == Variable.ACROSS:
+                letters[i][j:j + len(word)] = word
+            # Down words fill one cell in each row
+            else:
+                for k, letter in enumerate(word):
+                    letters[i + k][j] = letter
         return letters
 
     def print(self, assignment):
@@ -63,24 +92,28 @@ class CrosswordCreator():
         font = ImageFont.truetype("assets/fonts/OpenSans-Regular.ttf", 80)
         draw = ImageDraw.Draw(img)
 
-        for i in range(self.crossword.height):
-            for j in range(self.crossword.width):
+        # Measure every letter used once, the font doesn't change between cells
+        sizes = {
+            letter: draw.textsize(letter, font=font)
+            for letter in set("".join(assignment.values()))
+        }
 
-                rect = [
-                    (j * cell_size + cell_border,
-                     i * cell_size + cell_border),
-                    ((j + 1) * cell_size - cell_border,
-                     (i + 1) * cell_size - cell_border)
-                ]
-                if self.crossword.structure[i][j]:
-                    draw.rectangle(rect, fill="white")
-                    if letters[i][j]:
-                        w, h = draw.textsize(letters[i][j], font=font)
-                        draw.text(
-                            (rect[0][0] + ((interior_size - w) / 2),
-                             rect[0][1] + ((interior_size - h) / 2) - 10),
-                            letters[i][j], fill="black", font=font
-                        )
+        # Only the cells of the structure are drawn, the rest stays black
+        for i, j in self._cells:
+            rect = [
+                (j * cell_size + cell_border,
+                 i * cell_size + cell_border),
+                ((j + 1) * cell_size - cell_border,
+                 (i + 1) * cell_size - cell_border)
+            ]
+            draw.rectangle(rect, fill="white")
+            if letters[i][j]:
+                w, h = sizes[letters[i][j]]
+                draw.text(
+                    (rect[0][0] + ((interior_size - w) / 2),
+                     rect[0][1] + ((interior_size - h) / 2) - 10),
+                    letters[i][j], fill="black", font=font
+                )
 
         img.save(filename)
 
@@ -110,7 +143,47 @@ class CrosswordCreator():
                     remove.append(value)
             # Remove every value in the list
             for value in remove:
-                self.domains[domain].remove(value)
+                self.remove_value(domain, value)
+
+    def support(self, var):
+        """
+        Return the letter index of `var`'s domain: a list with, for each
+        position of the word, a mapping from letter to the set of words in
+        `self.domains[var]` that have that letter at that position.
+        """
+        if var not in self._support_index:
+            index = [defaultdict(set) for _ in range(var.length)]
+            for word in self.domains[var]:
+                for bucket, letter in zip(index, word):
+                    bucket[letter].add(word)
+            self._support_index[var] = index
+        return self._support_index[var]
+
+    def remove_value(self, var, value):
+        """
+        Remove `value` from `self.domains[var]`, keeping the letter index of
+        `var` up to date.
+        """
+        self.domains[var].remove(value)
+        self._trail.append((var, value))
+        if var in self._support_index:
+            for bucket, letter in zip(self._support_index[var], value):
+                bucket[letter].discard(value)
+                # Drop letters that no word has anymore, so the keys are the available letters
+                if not bucket[letter]:
+                    del bucket[letter]
+
+    def restore(self, mark):
+        """
+        Put back into the domains every value removed since the trail had
+        length `mark`, most recent first.
+        """
+        while len(self._trail) > mark:
+            var, value = self._trail.pop()
+            self.domains[var].add(value)
+            if var in self._support_index:
+                for bucket, letter in zip(self._support_index[var], value):
+                    bucket[letter].add(value)
 
     def revise(self, x, y):
         """
@@ -124,32 +197,24 @@ class CrosswordCreator():
         revised = False
 
         # If there is an overlap between x and y
-        if self.crossword.overlaps[x, y] is not None:
+        if self._overlap[x, y] is not None:
             # Save the x and y indexes
-            x_idx, y_idx = self.crossword.overlaps[x, y]
+            x_idx, y_idx = self._overlap[x, y]
+            # Words in x's and y's domains grouped by the letter they have at the overlap
+            x_support = self.support(x)[x_idx]
+            y_support = self.support(y)[y_idx]
             # Save the domain values to be removed in a set to not alter the loop range
             remove = set()
 
-            # Compare the values in x.domain with the values in y.domain
-            for x_value in self.domains[x]:
-                # Create a flag
-                removable = True
-                # Loop over variable y's domain
-                for y_value in self.domains[y]:
-                    # If the value can be used
-                    if x_value[x_idx] == y_value[y_idx]:
-                        # Dont remove
-                        removable = False
-                        break
-                # If it's not arc consistant, add to the remove set
-                if removable:
-                    remove.add(x_value)   
+            # Letters available in x.domain but not in y.domain at the overlap, none of their values are arc consistant
+            for letter in x_support.keys() - y_support.keys():
+                remove.update(x_support[letter])
 
             # Remove the values tagged to remove from the domain of variable x, and return True, meaning changes were made
             for value in remove:
-                self.domains[x].remove(value)
+                self.remove_value(x, value)
                 revised = True
-            
+
         return revised
 
     def ac3(self, arcs=None):
@@ -163,26 +228,39 @@ class CrosswordCreator():
         """
         # If no arc given
         if arcs is None:
-            queue = self.crossword.overlaps.copy()
+            queue = deque(
+                arc for arc, overlap in self._overlap.items() if overlap
+            )
         # Inference arc
         else:
-            queue = arcs
+            queue = deque(arcs)
+        # Keep track of the arcs in the queue to not add them twice
+        in_queue = set(queue)
 
         # Loop while there are items in the queue
-        while len(queue) > 0:
-            # Save the item keys (variable objects), and remove it
-            x, y = list(queue.keys())[0]
-            queue.pop((x, y))
+        while queue:
+            # Take the first arc out of the queue
+            x, y = queue.popleft()
+            in_queue.discard((x, y))
+
+            # Count the letters available at each position of x, to know where x loses some
+            letters = [len(bucket) for bucket in self.support(x)]
 
             # Check with revise(x, y) if any value has to be removed
             if self.revise(x, y):
                 # No solution if the domain of x is empty
                 if len(self.domains[x]) == 0:
                     return False
-                # Add the arcs of x and its neighbors to the queue
-                for neighbor in (self.crossword.neighbors(x) - {y}):
-                    overlap = self.crossword.overlaps[x, neighbor]
-                    queue[x, neighbor] = overlap
+                # Add the arcs of x's neighbors towards x to the queue, but only if x lost a letter
+                # where they overlap, otherwise every neighbor value still has the same support
+                support = self.support(x)
+                for neighbor in (self._neighbors[x] - {y}):
+                    x_idx = self._overlap[x, neighbor][0]
+                    if len(support[x_idx]) == letters[x_idx]:
+                        continue
+                    if (neighbor, x) not in in_queue:
+                        queue.append((neighbor, x))
+                        in_queue.add((neighbor, x))
         return True
 
     def assignment_complete(self, assignment):
@@ -190,40 +268,67 @@ class CrosswordCreator():
         Return True if `assignment` is complete (i.e., assigns a value to each
         crossword variable); return False otherwise.
         """
-        # Check that the keys in assignment are the same as the varibales in the crossword
-        if assignment.keys() == self.crossword.variables:
-            return True
-        return False
+        # Assignment only has crossword variables as keys, so it's complete when it has all of them
+        return len(assignment) == self._n_vars
 
-    def consistent(self, assignment):
+    def consistent(self, assignment, new_var=None):
         """
         Return True if `assignment` is consistent (i.e., words fit in crossword
         puzzle without conflicting characters); return False otherwise.
+
+        If `new_var` is given, the rest of `assignment` is taken as already
+        consistent and only the value of `new_var` is checked against it. The
+        caller must make sure that value is not used by another variable, as
+        `backtrack` does with its set of used words.
         """
-        # Loop, compairing every variable and value in assignment
-        for x in assignment:
-            for y in assignment:
+        # Without a new variable, check every variable in assignment
+        if new_var is None:
+            # Check that values are distinct
+            if len(set(assignment.values())) != len(assignment):
+                return False
+            variables = assignment
+        else:
+            variables = [new_var]
 
-                # Skip when checking the same
-                if x == y:
-                    continue
-                
-                # Check that values are distinct
-                if assignment[x] == assignment[y]:
-                    return False
-                
-                # Check overlap conflict
-                if self.crossword.overlaps[x, y] != None:
-                    x_idx, y_idx = self.crossword.overlaps[x, y]
-                    if assignment[x][x_idx] != assignment[y][y_idx]:
-                        return False
-            
-            # Check if the length of the value is consistant with the length of the variable
-            if len(assignment[x]) != x.length:
+        # Check the length and the overlap conflicts of every variable with its own checker
+        for x in variables:
+            if not self._checks[x](assignment):
                 return False
 
         return True
 
+    def compile_check(self, var):
+        """
+        Return a function that takes an assignment and returns True if the
+        value of `var` has the right length and agrees with the values of its
+        assigned neighbors where they overlap.
+
+        The crossword structure doesn't change, so the function is generated
+        with the neighbors and overlap indexes of `var` written into it.
+        """
+        names = {"var": var}
+        lines = [
+            "    word = assignment[var]",
+            f"    if len(word) != {var.length}:",
+            "        return False",
+        ]
+        for k, neighbor in enumerate(self._neighbors[var]):
+            names[f"n{k}"] = neighbor
+            x_idx, y_idx = self._overlap[var, neighbor]
+            lines += [
+                f"    other = assignment.get(n{k})",
+                f"    if other is not None and word[{x_idx}] != other[{y_idx}]:",
+                "        return False",
+            ]
+        lines.append("    return True")
+
+        # Pass the variables as default arguments, so they are local variables of the function
+        args = "".join(f", {name}={name}" for name in names)
+        source = f"def check(assignment{args}):\n" + "\n".join(lines) + "\n"
+        namespace = dict(names)
+        exec(source, namespace)
+        return namespace["check"]
+
     def order_domain_values(self, var, assignment):
         """
         Return a list of values in the domain of `var`, in order by
@@ -231,29 +336,27 @@ class CrosswordCreator():
         The first value in the list, for example, should be the one
         that rules out the fewest values among the neighbors of `var`.
         """
-        # Create a dict with the values associated to the total of values removed in neighbors when assigned
-        sums = {value: 0 for value in self.domains[var]}
+        # Count for every value the total of values removed in neighbors when assigned
+        sums = {}
 
         # Assign a value to var from its domain
         for value in self.domains[var]:
+            sums[value] = 0
             # Check it against every neighbor of var
-            for neighbor in self.crossword.neighbors(var):
+            for neighbor in self._neighbors[var]:
                 # Skip already assigned variables
                 if neighbor in assignment:
                     continue
                 # Check different words consistency, if the same value is in both domains, add 1 to value's sum
                 if value in self.domains[neighbor]:
                     sums[value] += 1
-                # Check arc consistency
-                var_idx, neighbor_idx = self.crossword.overlaps[var, neighbor]
-                for neighbor_value in self.domains[neighbor]:
-                    if value[var_idx] != neighbor_value[neighbor_idx]:
-                        sums[value] += 1
+                # Check arc consistency, every neighbor value without the same letter at the overlap is ruled out
+                var_idx, neighbor_idx = self._overlap[var, neighbor]
+                matches = self.support(neighbor)[neighbor_idx].get(value[var_idx], ())
+                sums[value] += len(self.domains[neighbor]) - len(matches)
 
         # Sort the values by the total of words it rules out
-        return dict(sorted(sums.items(), key=lambda sums: sums[1]))
-        
-        
+        return sorted(sums, key=sums.get)
 
     def select_unassigned_variable(self, assignment):
         """
@@ -263,63 +366,66 @@ class CrosswordCreator():
         degree. If there is a tie, any of the tied variables are acceptable
         return values.
         """
-        # Create a dictionary with unassigned variables as keys, and it's amount of values left in the domain and 
-        # the amount of neighbors as values
-        domains = {}
-        for variable in self.crossword.variables:
-            if variable in assignment.keys():
-                continue
-            domains[variable] = [len(self.domains[variable]), len(self.crossword.neighbors(variable))] 
-
-        # Sort by MRV from lowest to highest
-        domains = dict(sorted(domains.items(), key=lambda domain: domain[1][0]))
-
-        # Check if more than one have the same MRV value
-        first_key = list(domains.keys())[0]
-        repeats_mrv = 0
-        for variable in domains.keys():
-            if domains[variable][0] == domains[first_key][0]:
-                repeats_mrv += 1
-        # If no repeats, return the lowest MRV
-        if repeats_mrv == 1:
-            return first_key
-
-        # If there are more than one with the same MRV value
-        else:
-            # From the ones that have the same MRV, sort them by degree
-            new_domain = list(domains.items())[:repeats_mrv]
-            # Sort by degree from highest to lowest
-            domains = dict(sorted(new_domain, key=lambda domain: domain[1][1], reverse=True)) # Only sort again the ones repeated
-            first_key = list(domains.keys())[0]
-            repeats_degree = []
-            # Check if there are more than one with the same Degree of the mrv repeated variables
-            for variable in domains.keys():
-                if domains[variable][1] == domains[first_key][1]:
-                    repeats_degree.append(variable)
-            # If there are more than one
-            if len(repeats_degree) > 1:
-                # Return a random choice
-                var = random.choice(repeats_degree)
-                # Couldn't figure out why the variable object kinda broke when chosen with random library
-                # So, search the random vriable in self.crossword.variables and return it
-                for variable in self.crossword.variables:
-                    if variable == var:
-                        return variable
-            # Else, return the one with the highest degree
-            return repeats_degree[0]
-       
-            
-
-    def backtrack(self, assignment):
+        # Rank every unassigned variable by its amount of values left in the domain (lowest first)
+        # and then by its amount of neighbors (highest first)
+        unassigned = [v for v in self._var_list if v not in assignment]
+        rank = {
+            v: (len(self.domains[v]), -len(self._neighbors[v]))
+            for v in unassigned
+        }
+        best = min(rank.values())
+
+        # If there is a tie, return a random choice between the tied variables
+        ties = [v for v in unassigned if rank[v] == best]
+        if len(ties) == 1:
+            return ties[0]
+        return random.choice(ties)
+
+    def inferences(self, assignment, var, used):
+        """
+        Forward check the value just assigned to `var`: reduce the domain of
+        `var` to that value and make its neighbors arc consistent with it.
+        Then assign every unassigned variable left with a single value.
+
+        Return the list of variables assigned this way, or None if the
+        assignment can't be completed. Domain changes are left on the trail.
+        """
+        # Only the assigned value remains in var's domain
+        for value in self.domains[var] - {assignment[var]}:
+            self.remove_value(var, value)
+        # Make every neighbor consistent with var, and propagate from there
+        if not self.ac3([(neighbor, var) for neighbor in self._neighbors[var]]):
+            return None
+
+        # Assign the variables that have only 1 value left in their domain
+        inferred = []
+        for variable in self._var_list:
+            if variable not in assignment and len(self.domains[variable]) == 1:
+                value = next(iter(self.domains[variable]))
+                assignment[variable] = value
+                if value in used or not self.consistent(assignment, variable):
+                    # Delete the values inferred so far
+                    del assignment[variable]
+                    for other in inferred:
+                        used.discard(assignment.pop(other))
+                    return None
+                inferred.append(variable)
+                used.add(value)
+        return inferred
+
+    def backtrack(self, assignment, used=None):
         """
         Using Backtracking Search, take as input a partial assignment for the
         crossword and return a complete assignment if possible to do so.
 
         `assignment` is a mapping from variables (keys) to words (values).
+        `used` is the set of words in `assignment`, computed if not given.
 
         If no assignment is possible, return None.
         """
-        
+        if used is None:
+            used = set(assignment.values())
+
         # If assignment complete, return assignment
         if self.assignment_complete(assignment):
             return assignment
@@ -329,35 +435,30 @@ class CrosswordCreator():
 
         # Loop over the ordered values
         for value in self.order_domain_values(var, assignment):
+            # Skip words already used by another variable
+            if value in used:
+                continue
+            # Remember where the trail is, to undo the inferences made with this value
+            mark = len(self._trail)
             # Start by assigning the first value
             assignment[var] = value
-            # If the value keeps the consistency in the problem
-            if self.consistent(assignment):
-
-                # Try inferring, looping over the variables
-                for variable in self.crossword.variables:
-                    # If the variable is unassigned and the domain has only 1 value, check assigning it
-                    if variable not in assignment and len(self.domains[variable]) == 1:
-                        # Create a queue for ac3
-                        queue = {}
-                        for neighbor in self.crossword.neighbors(variable):
-                            queue[variable, neighbor] = self.crossword.overlaps[variable, neighbor]
-                        # Check if the value in ac3 keeps the consistency
-                        if self.ac3(queue):
-                            # Assign the value if it works
-                            for value in self.domains[variable]:
-                                assignment[variable] = value
-                        # Delete the assignment if it doesn't work, and try with the next unassigned variable with 1 value in its domain
-                        else:
-                            del assignment[variable]
-
-                # Call backtrack recursiveness    
-                result = self.backtrack(assignment)
-                # If assignment done, return the assignment
-                if result:
-                    return result
-            # Delete the value assigned if none of the previous conditions work, and check the next value
+            used.add(value)
+            # If the value keeps the consistency in the problem, try inferring from it
+            if self.consistent(assignment, var):
+                inferred = self.inferences(assignment, var, used)
+                if inferred is not None:
+                    # Call backtrack recursiveness
+                    result = self.backtrack(assignment, used)
+                    # If assignment done, return the assignment
+                    if result:
+                        return result
+                    # Delete the inferred values
+                    for variable in inferred:
+                        used.discard(assignment.pop(variable))
+            # Delete the value assigned if none of the previous conditions work, restore the domains and check the next value
             del assignment[var]
+            used.discard(value)
+            self.restore(mark)
         # Return None if after looping over every value there's no solution
         return None
 